@@ -34,13 +34,22 @@ import pprint
 import collections
 import enum
 import datetime
-import math
 import re
 import sys
 import fnmatch
+import filecmp
 import argparse
-
-ChangeType = enum.Enum("ChangeType",
+import io
+import array
+import bisect
+import concurrent.futures
+import functools
+import hashlib
+import pickle
+
+#an IntEnum, so a ChangeType can be stored in an array
+#as is, without looking up .value for every line
+ChangeType = enum.IntEnum("ChangeType",
     "NEW_CHUNK INSERTED DELETED CONTEXT ADDED_FILE REMOVED_FILE DIFFERING_BINARY"
 )
 
@@ -51,6 +60,40 @@ ChangeInfo = collections.namedtuple( "ChangeInfo",
     "type line1 line2 content"
 )
 
+CHANGE_TYPES = { t.value: t for t in ChangeType }
+
+#all of the changes for one file. Diffs can be millions of
+#lines long, so instead of one ChangeInfo per line this keeps
+#each field in its own array; ChangeInfo tuples are made on
+#the fly when the changes are read back.
+class FileChanges:
+    __slots__ = ("types", "line1", "line2", "content")
+
+    def __init__(self):
+        self.types = array.array("B")
+        self.line1 = array.array("i")
+        self.line2 = array.array("i")
+        self.content = []
+
+    def add(self, changeType, line1, line2, content):
+        self.types.append(changeType)
+        self.line1.append(line1)
+        self.line2.append(line2)
+        self.content.append(content)
+
+    def maxLine(self):
+        return max( max(self.line1,default=0), max(self.line2,default=0) )
+
+    def __len__(self):
+        return len(self.content)
+
+    def __getitem__(self, i):
+        return ChangeInfo( CHANGE_TYPES[self.types[i]], self.line1[i], self.line2[i], self.content[i] )
+
+    def __iter__(self):
+        for t,l1,l2,c in zip(self.types, self.line1, self.line2, self.content):
+            yield ChangeInfo( CHANGE_TYPES[t], l1, l2, c )
+
 def error(msg):
     sys.stderr.write(msg)
     sys.stderr.write("\n")
@@ -99,42 +142,84 @@ def parseDashPattern(p):
 #to verify group 1 is not keyword: if, while, etc.
 funcrex = re.compile(r"\s*([A-Za-z_]\w*\s+)*([A-Za-z_]\w*)\s*\([^)]*\)\s*\{")
 classrex = re.compile(r"\s*(public\s+)?class\s+(\w+)\s*[:{]")
-def getContainingFunction(filename, lineNumber):
+#everything funcrex matches before the ( is letters, digits,
+#underscores, and whitespace; this is the part from the ( on
+notWordOrSpaceRex = re.compile(r"[^\w\s]")
+funcTailRex = re.compile(r"\([^)]*\)\s*\{")
+
+#the classes and functions declared in a file, as
+#lists of the lines where each one starts. Each file is
+#read and scanned once no matter how many chunks it has
+@functools.lru_cache(maxsize=128)
+def getDeclarations(filename):
     with open(filename,errors="ignore") as fp:
         data = fp.read()
+
+    #classrex can't match without the word class, and checking
+    #for that is much cheaper than trying it on every line
+    lookForClasses = "class" in data
+
+    #funcrex can only match at idx if the first character
+    #after idx that isn't a letter, digit, underscore, or
+    #whitespace is a ( that funcTailRex matches at. That
+    #character is found once for a whole run of lines, and
+    #once funcrex matches in the run, the lines after it up
+    #to the function's name give the same match. Otherwise
+    #funcrex would rescan the same words from the start of
+    #each line, which is very slow for long stretches of text
+    stopAt=-1
+    canBeFunc=False
+    funcMatch=None
+
     idx=0
     lineNum=1
-    klass=""
-    func=""
-
-    def checkClass():
-        nonlocal klass
-        M = classrex.match(data,idx)
+    classLines=[]
+    classes=[]
+    funcLines=[]
+    funcs=[]
+    while True:
+        M = lookForClasses and classrex.match(data,idx)
         if M:
-            klass = "class "+M.group(2)
-
-    def checkFunc():
-        nonlocal func
-        M = funcrex.match(data,idx)
+            classLines.append(lineNum)
+            classes.append("class "+M.group(2))
+        if stopAt < idx:
+            M = notWordOrSpaceRex.search(data,idx)
+            stopAt = M.start() if M else len(data)
+            canBeFunc = funcTailRex.match(data,stopAt) != None
+            funcMatch = None
+        if not canBeFunc:
+            M = None
+        elif funcMatch and idx <= funcMatch.start(2):
+            M = funcMatch
+        else:
+            M = funcrex.match(data,idx)
+            if M:
+                funcMatch = M
         if M:
             word = M.group(2)
             if word not in ["if","while","for","foreach","switch"]:
-                func = "function "+word
-
-    if idx == len(data) or lineNum >= lineNumber:
-        checkClass()
-        checkFunc()
-
-    while idx < len(data) and lineNum < lineNumber:
-
-        checkClass()
-        checkFunc()
-
+                funcLines.append(lineNum)
+                funcs.append("function "+word)
         i = data.find("\n", idx )
         if i == -1:
-            return "[not in a function]"
+            break
         idx = i+1
         lineNum+=1
+    missingNewline = len(data) > 0 and not data.endswith("\n")
+    return classLines, classes, funcLines, funcs, lineNum, missingNewline
+
+def getContainingFunction(filename, lineNumber):
+    classLines, classes, funcLines, funcs, lastLine, missingNewline = getDeclarations(filename)
+    if missingNewline and lineNumber > lastLine:
+        return "[not in a function]"
+
+    #only declarations before lineNumber count
+    #(or on the first line, if that's where lineNumber is)
+    lastChecked = max(lineNumber-1,1)
+    i = bisect.bisect_right(classLines,lastChecked)
+    klass = classes[i-1] if i > 0 else ""
+    i = bisect.bisect_right(funcLines,lastChecked)
+    func = funcs[i-1] if i > 0 else ""
 
     if klass and func:
         return f"{klass} , {func}"
@@ -209,6 +294,7 @@ def main():
     parser.add_argument("--show-containing-function", default="yes", choices=["yes","no"],help=f"Show containing function for each chunk (yes or no)")
     parser.add_argument("--containing-function-font", default="Courier-Oblique", help=f"Font for containing function. {FONT_HELP}")
     parser.add_argument("--containing-function-color", default="0.5,0.5,0.5", help=f"Color for containing function. {COLOR_HELP}")
+    parser.add_argument("--diff-cache", default="no", choices=["yes","no"], help=f"Reuse the differences from an earlier run if no file's size or timestamps have changed (yes or no). Only use this if files can't be changed without changing their timestamps. Cached in {DIFF_CACHE_DIR}")
 
     #insert-text 0,0.5,0
     #delete-text 0,5,0,0
@@ -249,7 +335,7 @@ def main():
     headerMargin = toPoints(args.header_margin)
     contentMarginTop = toPoints(args.content_margin_top)
     contentMarginBottom = toPoints(args.content_margin_bottom)
-    footerMargin = toPoints(args.content_margin_bottom)
+    footerMargin = toPoints(args.footer_margin)
     leftMargin = toPoints(args.left_margin)
     rightMargin = toPoints(args.right_margin)
 
@@ -263,31 +349,47 @@ def main():
     colorInsertedBackground = toColor(args.color_insert_background)
     colorDeletedBackground = toColor(args.color_delete_background)
     #textColor = (0,0,0)
+    lineNumberColors = {
+        ChangeType.INSERTED: colorInsertLineNumber,
+        ChangeType.DELETED: colorDeleteLineNumber,
+        ChangeType.CONTEXT: colorContextLineNumber
+    }
+    #foreground and background
+    textColors = {
+        ChangeType.INSERTED: (colorInsertedText, colorInsertedBackground),
+        ChangeType.DELETED: (colorDeletedText, colorDeletedBackground),
+        ChangeType.CONTEXT: (colorContextText, colorContextBackground)
+    }
     headerLineColor = toColor(args.color_margin_line)
     chunkSeparatorColor = toColor(args.color_chunk_separator)
     filenameColor = toColor(args.color_filename)
     filenameLinesColor = toColor(args.color_filename_lines)
-    ignoreBlankLines=args.ignore_blank_lines
+    ignoreBlankLines = (args.ignore_blank_lines=="yes")
     strikeoutWidth = toPoints(args.strikeout_width)
     underlineWidth = toPoints(args.underline_width)
     headerLineWidth = toPoints(args.header_line_width)
-    underlinePattern = parseDashPattern(args.underline_pattern)
+    underlinePattern = tuple(parseDashPattern(args.underline_pattern))
     showContainingFunction = (args.show_containing_function=="yes")
     containingFunctionFontFile = args.containing_function_font
     containingFunctionColor = toColor(args.containing_function_color)
+    useDiffCache = (args.diff_cache=="yes")
 
     dir1 = args.path1
     dir2 = args.path2
 
-    tmp=[]
+    #drop the path components the two paths have in common
+    #at the front and at the back
     p1 = os.path.abspath(dir1).split(os.path.sep)
     p2 = os.path.abspath(dir2).split(os.path.sep)
-    while len(p1) and len(p2) and p1[0] == p2[0]:
-        p1.pop(0)
-        p2.pop(0)
-    while len(p1) and len(p2) and p1[-1] == p2[-1]:
-        p1.pop()
-        p2.pop()
+    n = min(len(p1),len(p2))
+    start=0
+    while start < n and p1[start] == p2[start]:
+        start+=1
+    end=0
+    while end < n-start and p1[-1-end] == p2[-1-end]:
+        end+=1
+    p1 = p1[start:len(p1)-end]
+    p2 = p2[start:len(p2)-end]
     if len(p2) == 0:
         pathdelta = os.path.basename(dir1) + "→" + os.path.basename(dir2)
     else:
@@ -326,31 +428,52 @@ def main():
 
     ascent, descent = reportlab.pdfbase.pdfmetrics.getAscentDescent( normalFontName, fontSize)
 
-    numPages=0
-
     pageIsOpen=False
     pageNum=1
+    #all of the text on a page goes in one text object, which
+    #is drawn when the page is finished
+    pageText=None
+    pageTextColor=None
+    pageTextFont=None
+    #fill color last set on the page (outside the text object)
+    pageFillColor=None
+    #strikeouts and underlines on the page, grouped by
+    #(color,width,dash pattern); each group is drawn as one
+    #path when the page is finished
+    pageLines=collections.defaultdict(list)
     numLineNumberDigits=1       #FIXME
 
 
-    def getHeaderAndFooter():
-        tmp=[]
-        for s in [headerLeft, headerRight, footerLeft, footerRight]:
-            s = s.replace("{pagenum}", str(pageNum) )
-            s = s.replace("{numpages}", str(numPages-1) )
-            s = s.replace("{today}", today )
-            s = s.replace("{path1}", dir1 )
-            s = s.replace("{path2}", dir2 )
-            s = s.replace("{paths}", pathdelta )
-            tmp.append(s)
+    needNumPages = any( "{numpages}" in s for s in [headerLeft, headerRight, footerLeft, footerRight] )
+
+    #{pagenum} and {numpages} are the only parts of the header
+    #and footer that change from page to page, so the rest is
+    #filled in once. Each template is split into a list where
+    #the odd entries are {pagenum} or {numpages}
+    def splitTemplate(s):
+        tmp = re.split(r"(\{pagenum\}|\{numpages\})", s)
+        for i in range(0,len(tmp),2):
+            tmp[i] = tmp[i].replace("{today}", today )
+            tmp[i] = tmp[i].replace("{path1}", dir1 )
+            tmp[i] = tmp[i].replace("{path2}", dir2 )
+            tmp[i] = tmp[i].replace("{paths}", pathdelta )
         return tmp
 
-    def preparePage():
-        nonlocal pageIsOpen,Y,pageNum,numPages
-        if pageIsOpen:
-            return
+    headerAndFooterTemplates = [ splitTemplate(s) for s in
+        [headerLeft, headerRight, footerLeft, footerRight]
+    ]
+
+    def getHeaderAndFooter(pageNum,numPages):
+        values = { "{pagenum}": str(pageNum), "{numpages}": str(numPages) }
+        tmp=[]
+        for parts in headerAndFooterTemplates:
+            tmp.append( "".join(
+                values[q] if i%2 else q for i,q in enumerate(parts)
+            ) )
+        return tmp
 
-        hl, hr, fl, fr = getHeaderAndFooter()
+    def drawHeaderAndFooter(pageNum,numPages):
+        hl, hr, fl, fr = getHeaderAndFooter(pageNum,numPages)
 
         cvs.setFillColorRGB(0,0,0)
         cvs.setStrokeColorRGB(0,0,0)
@@ -361,9 +484,20 @@ def main():
         cvs.drawString(leftMargin, footerMargin-fontSize, fl )
         cvs.drawRightString(pageWidth-rightMargin, footerMargin-fontSize, fr )
 
+    def preparePage():
+        nonlocal pageIsOpen,Y,pageNum,pageText,pageTextColor,pageTextFont,pageFillColor
+        if pageIsOpen:
+            return
+
+        #we don't know the page count until everything has been
+        #laid out, so if it's needed the header and footer go in
+        #a form that gets filled in after the last page
+        if needNumPages:
+            cvs.doForm(f"headerFooter{pageNum}")
+        else:
+            drawHeaderAndFooter(pageNum,None)
+
         pageNum+=1
-        if numPages < pageNum:
-            numPages = pageNum
 
         cvs.setStrokeColorRGB(*headerLineColor)
 
@@ -375,6 +509,10 @@ def main():
                   pageWidth-rightMargin, contentMarginTop
         )
         # ~ cvs.setStrokeColorRGB(0,0,0)
+        pageText = cvs.beginText()
+        pageTextColor=None
+        pageTextFont=None
+        pageFillColor=None
         pageIsOpen=True
         Y = pageHeight - contentMarginBottom - fontSize
 
@@ -382,6 +520,8 @@ def main():
         nonlocal pageIsOpen
         if not pageIsOpen:
             return
+        drawStrikeoutsAndUnderlines()
+        cvs.drawText(pageText)
         cvs.showPage()
         pageIsOpen=False
 
@@ -390,166 +530,206 @@ def main():
         if pageIsOpen and Y < contentMarginBottom:
             endPage()
 
-    def drawLine(x1,y1,x2,y2,weight,color, **kw):
+    #make sure there's an open page with room for a line at Y.
+    #Callers check pageIsOpen and Y first, since almost always
+    #there's nothing to do
+    def makeRoom():
         checkIfPageIsFull()
         preparePage()
+
+    def drawLine(x1,y1,x2,y2,weight,color, **kw):
+        if not pageIsOpen or Y < contentMarginBottom:
+            makeRoom()
         cvs.setStrokeColorRGB(*color)
         cvs.setLineWidth(weight)
         cvs.setDash(kw.get("dash",[]))
         cvs.line(x1,y1,x2,y2)
 
-    def outputLineNumber(cvs,Y,lineNumber,isFirstLine,changeType):
-        t = cvs.beginText(leftMargin,Y)
-        match(changeType):
-            case ChangeType.INSERTED:
-                color = colorInsertLineNumber
-            case ChangeType.DELETED:
-                color = colorDeleteLineNumber
-            case ChangeType.CONTEXT:
-                color = colorContextLineNumber
-            case _:
-                assert 0,f"{changeType}"
-
-        t.setFillColorRGB(*color)
-        t.setStrokeColorRGB(*color)
-        t.setFont(normalFontName,fontSize)
+    def textAt(x,y,txt,color,font=None):
+        #add txt to the page's text at (x,y); returns the
+        #x coordinate just past the end of it. The color and
+        #font are only emitted when they change.
+        nonlocal pageTextColor,pageTextFont
+        if font == None:
+            font = normalFontName
+        pageText.setTextOrigin(x,y)
+        if color != pageTextColor:
+            pageText.setFillColorRGB(*color)
+            pageTextColor = color
+        if font != pageTextFont:
+            pageText.setFont(font,fontSize)
+            pageTextFont = font
+        pageText.textOut(txt)
+        return pageText.getX()
+
+    def outputLineNumber(Y,lineNumber,isFirstLine,changeType):
+        color = lineNumberColors[changeType]
+
         if lineNumber == None:
-            t.textOut( " "*(numLineNumberDigits+1) )
+            s = " "*(numLineNumberDigits+1)
         elif isFirstLine:
             formatString = "{:"+str(numLineNumberDigits)+"d} "
-            t.textOut( formatString.format(lineNumber) )
+            s = formatString.format(lineNumber)
         else:
             if numLineNumberDigits > 3:
                 numdots = 3
             else:
                 numdots = numLineNumberDigits
-            t.textOut( ("."*numdots) + " " )
-        #t.setFillColorRGB(*textColor)
-        #t.setStrokeColorRGB(*textColor)
-        x = t.getX()
-        cvs.drawText(t)
-        return x
-
-    def drawStrikeoutsAndUnderlines(strikes,underlines):
-        currcolor = None
-        currw = None
-        currdash=None
-        for x1,x2,y,width,color,dashPattern in strikes+underlines:
-            if currcolor != color:
-                cvs.setStrokeColorRGB( *color )
-                currcolor = color
-            if currw != width:
-                cvs.setLineWidth( width )
-                currw = width
-            dashPattern = tuple(dashPattern)
-            if currdash != dashPattern:
-                cvs.setDash(dashPattern)
-                currdash = dashPattern
-            dp = tuple(dashPattern)
-            cvs.line( x1,y,x2,y )
+            s = ("."*numdots) + " "
+        return textAt(leftMargin,Y,s,color)
+
+    def drawStrikeoutsAndUnderlines():
+        for (color,width,dashPattern),segments in pageLines.items():
+            cvs.setStrokeColorRGB( *color )
+            cvs.setLineWidth( width )
+            cvs.setDash(dashPattern)
+            p = cvs.beginPath()
+            for x1,x2,y in segments:
+                p.moveTo(x1,y)
+                p.lineTo(x2,y)
+            cvs.drawPath( p, stroke=1, fill=0 )
         cvs.setDash([])
+        pageLines.clear()
 
     def drawRect(x,y,w,h,color):
-        cvs.setFillColorRGB(*color)
+        nonlocal pageFillColor
+        if color != pageFillColor:
+            cvs.setFillColorRGB(*color)
+            pageFillColor = color
         cvs.rect(x,y,w,h,stroke=0,fill=1)
 
+    #font and size are fixed for the whole run, so each
+    #character's width only needs to be looked up once
+    @functools.lru_cache(maxsize=None)
     def charWidth(c):
         return reportlab.pdfbase.pdfmetrics.stringWidth(
             c, normalFontName, fontSize
         )
 
-    def outputText(txt, lineNumber, changeType):
-        nonlocal Y
-
-        checkIfPageIsFull()
-        preparePage()
-
-        x = outputLineNumber(cvs,Y,lineNumber,True,changeType)
-
-        t = cvs.beginText(x,Y)
-        t.setFont( normalFontName, fontSize )
-
-        match(changeType):
-            case ChangeType.INSERTED:
-                fg = colorInsertedText
-                bg = colorInsertedBackground
-            case ChangeType.DELETED:
-                fg = colorDeletedText
-                bg = colorDeletedBackground
-            case ChangeType.CONTEXT:
-                fg = colorContextText
-                bg = colorContextBackground
-            case _:
-                assert 0,f"{changeType}"
-        t.setFillColorRGB( *fg )
-
-        strikes = []
-        underlines = []
-        startDrawingLines=False
-
-        for c in txt:
-            doLineNumber=False
-            if t.getX() + charWidth(c)  >= pageWidth - rightMargin:
-                if changeType == ChangeType.DELETED:
-                    #truncate; draw arrow
-                    x1 = t.getX()+0.1*charWidth(c)
-                    x2 = t.getX()+charWidth(c)
-                    y1 = Y+0.5*fontSize
-                    y2 = y1 + 0.3*fontSize
-                    y3 = y1 - 0.3*fontSize
-                    cvs.setFillColorRGB( *colorDeletedText )
-                    p = cvs.beginPath()
-                    p.moveTo(x1,y2)
-                    p.lineTo(x1,y3)
-                    p.lineTo(x2,y1)
-                    p.lineTo(x1,y2)
-                    cvs.drawPath( p, stroke=0, fill=1)
-                    break
-                else:
-                    #go to next line down
-                    t.moveCursor(0,fontSize)
-                    Y -= fontSize
-                    doLineNumber=True
-
-            if Y < contentMarginBottom:
-                #we've filled the current page, so finish this text
-                #object and start a new page
-                cvs.drawText(t)
-                drawStrikeoutsAndUnderlines(strikes,underlines)
-                strikes=[]
-                underlines=[]
-                endPage()
-                preparePage()
-                t = cvs.beginText(leftMargin,Y)
-                doLineNumber=True
-            if doLineNumber:
-                outputLineNumber(cvs,Y,lineNumber,False,changeType)
-
+    #widths of the ASCII characters, indexed by character code,
+    #so the common case doesn't need a function call
+    asciiWidths = array.array("d", [ charWidth(chr(c)) for c in range(128) ] )
 
-            if not c.isspace():
-                startDrawingLines=True
-
-            if bg != None and startDrawingLines:
-                w = charWidth(c)
-                drawRect(t.getX(),Y+descent,w,fontSize*0.95, bg )
-
-            x1 = t.getX()
-            t.textOut(c)
-            x2 = t.getX()
-
-
-            if changeType == ChangeType.DELETED and startDrawingLines and strikeoutWidth > 0:
-                strikes.append( (x1,x2,Y + fontSize * 0.4, strikeoutWidth, colorDeletedText, []) )
-
-            if changeType == ChangeType.INSERTED and startDrawingLines and underlineWidth > 0:
-                underlines.append( (x1,x2,Y-0.07*fontSize, underlineWidth, colorInsertedText, underlinePattern ) )
-
-
-        cvs.drawText(t)
-        drawStrikeoutsAndUnderlines(strikes,underlines)
+    #for a monospaced font (such as the default, Courier) every
+    #printable ASCII character has the same width, so lines made
+    #of them don't need to be measured character by character
+    if len( set( asciiWidths[0x20:0x7f] ) ) == 1:
+        monoWidth = asciiWidths[0x20]
+    else:
+        monoWidth = None
+
+    #how many monospaced characters fit on a row starting at x0.
+    #x0 only depends on the number of line number digits, so
+    #this is only worked out a handful of times per run
+    @functools.lru_cache(maxsize=None)
+    def monoCharsPerRow(x0,xmax):
+        x=x0+monoWidth
+        n=1
+        while x + monoWidth < xmax:
+            x += monoWidth
+            n += 1
+        return n
 
-        strikes=[]
-        underlines=[]
+    def outputText(txt, lineNumber, changeType):
+        nonlocal Y,pageFillColor
+
+        if not pageIsOpen or Y < contentMarginBottom:
+            makeRoom()
+
+        x0 = outputLineNumber(Y,lineNumber,True,changeType)
+        xmax = pageWidth - rightMargin
+
+        fg,bg = textColors[changeType]
+
+        isMono = monoWidth != None and txt.isascii() and txt.isprintable()
+
+        #split the text into rows that fit between x0 and the
+        #right margin. Deleted text is truncated instead of wrapped.
+        rows=[]
+        truncateAt=None
+        firstNonSpace = len(txt)-len(txt.lstrip())
+        if isMono:
+            #every character is the same width, so the rows can
+            #be worked out arithmetically
+            perRow = monoCharsPerRow(x0,xmax)
+            if changeType == ChangeType.DELETED and len(txt) > perRow:
+                truncateAt = perRow
+                rows.append( (0,perRow) )
+            else:
+                for i in range(0,max(len(txt),1),perRow):
+                    rows.append( (i, min(i+perRow,len(txt))) )
+        else:
+            rowStart=0
+            x=x0
+            for i,c in enumerate(txt):
+                o = ord(c)
+                w = asciiWidths[o] if o < 128 else charWidth(c)
+                if x + w >= xmax and i > rowStart:
+                    if changeType == ChangeType.DELETED:
+                        truncateAt = i
+                        break
+                    rows.append( (rowStart,i) )
+                    rowStart=i
+                    x=x0
+                x += w
+            rows.append( (rowStart, len(txt) if truncateAt == None else truncateAt) )
+
+        for rowNum,(start,end) in enumerate(rows):
+            if rowNum > 0:
+                #go to next line down
+                Y -= fontSize
+                if Y < contentMarginBottom:
+                    #we've filled the current page, so finish
+                    #it and start a new one
+                    endPage()
+                    preparePage()
+                outputLineNumber(Y,lineNumber,False,changeType)
+
+            #leading whitespace gets no background and no lines
+            drawFrom = max(start,firstNonSpace)
+            x1=None
+            if isMono:
+                if drawFrom < end:
+                    x1 = x0 + (drawFrom-start)*monoWidth
+                x = x0 + (end-start)*monoWidth
+            else:
+                x=x0
+                for i in range(start,end):
+                    if i == drawFrom:
+                        x1 = x
+                    o = ord(txt[i])
+                    x += asciiWidths[o] if o < 128 else charWidth(txt[i])
+            x2 = x
+
+            if bg != None and x1 != None:
+                drawRect(x1,Y+descent,x2-x1,fontSize*0.95, bg )
+
+            textAt(x0,Y,txt[start:end],fg)
+
+            if x1 != None:
+                if changeType == ChangeType.DELETED and strikeoutWidth > 0:
+                    pageLines[ (colorDeletedText, strikeoutWidth, ()) ].append( (x1,x2,Y + fontSize * 0.4) )
+
+                if changeType == ChangeType.INSERTED and underlineWidth > 0:
+                    pageLines[ (colorInsertedText, underlineWidth, underlinePattern) ].append( (x1,x2,Y-0.07*fontSize) )
+
+        if truncateAt != None:
+            #truncated; draw arrow
+            w = charWidth(txt[truncateAt])
+            x1 = x+0.1*w
+            x2 = x+w
+            y1 = Y+0.5*fontSize
+            y2 = y1 + 0.3*fontSize
+            y3 = y1 - 0.3*fontSize
+            if colorDeletedText != pageFillColor:
+                cvs.setFillColorRGB( *colorDeletedText )
+                pageFillColor = colorDeletedText
+            p = cvs.beginPath()
+            p.moveTo(x1,y2)
+            p.lineTo(x1,y3)
+            p.lineTo(x2,y1)
+            p.lineTo(x1,y2)
+            cvs.drawPath( p, stroke=0, fill=1)
 
         #note: This function leaves Y at the last
         #line of text, so the caller must decrement Y
@@ -563,132 +743,127 @@ def main():
 
 
 
-    changeset = getDifferences(dir1,dir2)
-
-    #do twice: Once to get page count, once to render it
-    for i in range(2):
-        pageNum=1
-        print("*"*20)
-        cvs = reportlab.pdfgen.canvas.Canvas(
-            filename=outputFile,
-            pagesize=(pageWidth,pageHeight)
-        )
+    if useDiffCache:
+        changeset = getCachedDifferences(dir1,dir2,ignoreGlobs,ignoreBlankLines)
+    else:
+        changeset = getDifferences(dir1,dir2,ignoreGlobs,ignoreBlankLines)
 
-        preparePage()
-        i=0
-        for fname in sorted(changeset.keys()):
-            basename = os.path.basename(fname)
-            ignore=False
-            for p in ignoreGlobs:
-                if fnmatch.fnmatch(basename,p) :
-                    ignore=True
-                    break
-
-            if ignore:
-                continue
+    cvs = reportlab.pdfgen.canvas.Canvas(
+        filename=outputFile,
+        pagesize=(pageWidth,pageHeight)
+    )
 
-            SPACE=2
-            if Y < contentMarginBottom + SPACE+fontSize+SPACE+SPACE+fontSize:
-                endPage()
-
-
-            txt = os.path.basename(fname)
-
-            if len(changeset[fname]) >= 1 and changeset[fname][0].type == ChangeType.REMOVED_FILE:
-                txt += " [file deleted]"
-            if len(changeset[fname]) >= 1 and changeset[fname][0].type == ChangeType.ADDED_FILE:
-                txt += " [file added]"
-            if len(changeset[fname]) >= 1 and changeset[fname][0].type == ChangeType.DIFFERING_BINARY:
-                txt += " [binary files differ]"
-            preparePage()
-            drawLine(leftMargin,Y,pageWidth-rightMargin,Y,0.5,filenameLinesColor)
-            Y-=SPACE
-            drawLine(leftMargin,Y,pageWidth-rightMargin,Y,0.5,filenameLinesColor)
-            Y-=fontSize
-            cvs.setFillColorRGB(*filenameColor)
-            cvs.setStrokeColorRGB(*filenameColor)
-            cvs.setFont( normalFontName, fontSize )
-            cvs.drawCentredString(pageWidth/2,Y,txt)
-            Y-=SPACE
-            drawLine(leftMargin,Y,pageWidth-rightMargin,Y,0.5,filenameLinesColor)
-            Y-=SPACE
-            drawLine(leftMargin,Y,pageWidth-rightMargin,Y,0.5,filenameLinesColor)
-            Y-=fontSize
-
-            changes = changeset[fname]
-
-            i=0
-            firstChunk=True
-            while i < len(changes):
-                change = changes[i]
-                #change is a ChangeSet
-
-                if change.type == ChangeType.NEW_CHUNK:
-                    #draw separator
-                    if firstChunk:
-                        firstChunk=False
-                    else:
-                        drawChunkSeparator(Y)
-                        Y -= fontSize/4
-                        Y -= fontSize
-                    checkIfPageIsFull()
+    #shown after the name of a file that was added, removed,
+    #or is binary
+    fileLabels = {
+        ChangeType.REMOVED_FILE: " [file deleted]",
+        ChangeType.ADDED_FILE: " [file added]",
+        ChangeType.DIFFERING_BINARY: " [binary files differ]"
+    }
 
-                    numLineNumberDigits = 1+int(math.log10(max([change.line1,change.line2,1])))
+    preparePage()
+    i=0
+    for fname in sorted(changeset.keys()):
+        SPACE=2
+        if Y < contentMarginBottom + SPACE+fontSize+SPACE+SPACE+fontSize:
+            endPage()
 
-                    if showContainingFunction:
-                        filename1, filename2 = change.content
-                        # ~ print("CHCO:",change.content)
-                        # ~ containing1 = getContainingFunction(filename1, change.line1)
-                        containing2 = getContainingFunction(filename2, change.line2)
-                        if containing2:
-                            checkIfPageIsFull()
-                            preparePage()
 
-                            w = reportlab.pdfbase.pdfmetrics.stringWidth(containing2,
-                                containingFunctionFontName,
-                                fontSize
-                            )
+        changes = changeset[fname]
 
-                            t = cvs.beginText(pageWidth/2 - w/2, Y)
-                            t.setFillColorRGB( *containingFunctionColor )
-                            t.setFont( containingFunctionFontName, fontSize )
-                            t.textOut(containing2)
-                            cvs.drawText(t)
+        txt = os.path.basename(fname)
+        if len(changes) >= 1:
+            txt += fileLabels.get(changes[0].type,"")
+        preparePage()
+        drawLine(leftMargin,Y,pageWidth-rightMargin,Y,0.5,filenameLinesColor)
+        Y-=SPACE
+        drawLine(leftMargin,Y,pageWidth-rightMargin,Y,0.5,filenameLinesColor)
+        Y-=fontSize
+        w = reportlab.pdfbase.pdfmetrics.stringWidth(txt, normalFontName, fontSize)
+        textAt(pageWidth/2 - w/2, Y, txt, filenameColor)
+        Y-=SPACE
+        drawLine(leftMargin,Y,pageWidth-rightMargin,Y,0.5,filenameLinesColor)
+        Y-=SPACE
+        drawLine(leftMargin,Y,pageWidth-rightMargin,Y,0.5,filenameLinesColor)
+        Y-=fontSize
+
+        #use the same width for every line number in the file
+        numLineNumberDigits = len(str(max(changes.maxLine(),1)))
 
-                            # ~ cvs.drawCentredString(pageWidth - w/2,Y,containing2)
-                            Y -= fontSize
+        i=0
+        firstChunk=True
+        while i < len(changes):
+            change = changes[i]
+            #change is a ChangeSet
+
+            if change.type == ChangeType.NEW_CHUNK:
+                #draw separator
+                if firstChunk:
+                    firstChunk=False
+                else:
+                    drawChunkSeparator(Y)
+                    Y -= fontSize/4
+                    Y -= fontSize
+                checkIfPageIsFull()
+
+                if showContainingFunction:
+                    filename1, filename2 = change.content
+                    # ~ print("CHCO:",change.content)
+                    # ~ containing1 = getContainingFunction(filename1, change.line1)
+                    containing2 = getContainingFunction(filename2, change.line2)
+                    if containing2:
+                        if not pageIsOpen or Y < contentMarginBottom:
+                            makeRoom()
+
+                        w = reportlab.pdfbase.pdfmetrics.stringWidth(containing2,
+                            containingFunctionFontName,
+                            fontSize
+                        )
+
+                        textAt(pageWidth/2 - w/2, Y, containing2,
+                            containingFunctionColor, containingFunctionFontName
+                        )
+
+                        # ~ cvs.drawCentredString(pageWidth - w/2,Y,containing2)
+                        Y -= fontSize
 
 
 
 
 
-                elif change.type == ChangeType.DIFFERING_BINARY:
-                    pass
-                elif change.type == ChangeType.REMOVED_FILE:
-                    pass
-                elif change.type == ChangeType.ADDED_FILE:
-                    pass
-                elif change.type in (ChangeType.DELETED, ChangeType.INSERTED, ChangeType.CONTEXT):
-                    if ignoreBlankLines and len(change.content.strip() ) == 0:
-                        pass
-                    else:
-                        if change.type == ChangeType.DELETED:
-                            outputText(change.content,change.line1,change.type)
-                            Y -= fontSize
-                        elif change.type == ChangeType.INSERTED:
-                            outputText(change.content,change.line2,change.type)
-                            Y -= fontSize
-                        elif change.type == ChangeType.CONTEXT:
-                            outputText(change.content,change.line2,change.type)
-                            Y -= fontSize
-                        else:
-                            assert 0
+            elif change.type == ChangeType.DIFFERING_BINARY:
+                pass
+            elif change.type == ChangeType.REMOVED_FILE:
+                pass
+            elif change.type == ChangeType.ADDED_FILE:
+                pass
+            elif change.type in (ChangeType.DELETED, ChangeType.INSERTED, ChangeType.CONTEXT):
+                #blank lines have already been left out if
+                #they're being ignored
+                if change.type == ChangeType.DELETED:
+                    outputText(change.content,change.line1,change.type)
+                    Y -= fontSize
+                elif change.type == ChangeType.INSERTED:
+                    outputText(change.content,change.line2,change.type)
+                    Y -= fontSize
+                elif change.type == ChangeType.CONTEXT:
+                    outputText(change.content,change.line2,change.type)
+                    Y -= fontSize
                 else:
                     assert 0
+            else:
+                assert 0
+
+            i+=1
 
-                i+=1
+    endPage()
 
-        endPage()
+    if needNumPages:
+        numPages = pageNum-1
+        for n in range(1,pageNum):
+            cvs.beginForm(f"headerFooter{n}")
+            drawHeaderAndFooter(n,numPages)
+            cvs.endForm()
 
     print("Wrote",outputFile)
     cvs.save()
@@ -697,266 +872,344 @@ def main():
     return
 
 
-def insertedEntireFile( fname, changeset ):
+#bytes that count as text when deciding whether a file is binary
+TEXT_BYTES = bytes( b for b in range(256) if 0x20 <= b < 0x7f or b in b"\t\n\r" )
+
+def compileGlobs(globs):
+    #one regex that matches anything any of the globs match
+    if not globs:
+        return re.compile(r"(?!)")
+    return re.compile( "|".join( f"(?:{fnmatch.translate(g)})" for g in globs ) )
+
+def insertedEntireFile( fname, changeset, ignoreRex, ignoreBlankLines ):
 
     if os.path.isdir(fname):
         for dirpath,dirs,files in os.walk(fname):
             for f in files:
-                insertedEntireFile(os.path.join(dirpath,f), changeset)
+                if not ignoreRex.match(f):
+                    insertedEntireFile(os.path.join(dirpath,f), changeset, ignoreRex, ignoreBlankLines)
         return
 
     assert fname not in changeset
-    changeset[fname]=[]
-
-    changeset[fname].append(
-        ChangeInfo( type=ChangeType.ADDED_FILE,
-                    line1=1,
-                    line2=1,
-                    content=fname
-        )
-    )
-
-    with open(fname, errors="replace") as fp:
-        data = fp.read()
-    isBinary=False
-    #if we have more than 50% of file is binary, note that fact
-    numBin=0
-    numAscii=0
-    for c in data[:100]:
-        if c.isascii() and c.isprintable():
-            numAscii+=1
-        else:
-            numBin+=1
-    totalChars = numBin+numAscii
-    if totalChars > 0:
-        if numBin / totalChars >= 0.5:
+    changeset[fname]=FileChanges()
+
+    changeset[fname].add( ChangeType.ADDED_FILE, 1, 1, fname )
+
+    #only the start of the file is needed to tell whether it's
+    #binary, and a binary file's contents aren't shown at all
+    with open(fname,"rb") as fp:
+        head = fp.read(4096)
+        #if we have more than 50% of file is binary, note that fact
+        numBin = len(head.translate(None,TEXT_BYTES))
+        numAscii = len(head)-numBin
+        if len(head) > 0 and numBin / len(head) >= 0.5:
             data = "This file contains binary data"
+        else:
+            fp.seek(0)
+            data = io.TextIOWrapper(fp,errors="replace").read()
     print(fname,"is",numBin,numAscii)
 
     lines = data.split("\n")
     for idx,txt in enumerate(lines):
-        changeset[fname].append(
-            ChangeInfo( type=ChangeType.INSERTED,
-                        line1=1,
-                        line2=idx+1,
-                        content=txt
-            )
-        )
+        if ignoreBlankLines and (txt == "" or txt.isspace()):
+            continue
+        changeset[fname].add( ChangeType.INSERTED, 1, idx+1, txt )
+
+#bump this whenever the layout of the changeset changes
+#so that stale cache files are not loaded
+DIFF_CACHE_VERSION=3
+DIFF_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "diffcode"
+)
+#only this many of the most recently used cache files are kept
+DIFF_CACHE_MAX_FILES=16
+
+def getTreeSignature(dirname, hasher):
+    #feed the path, modification and change times, inode, and
+    #size of everything under dirname into hasher. The change
+    #time can't be set back by hand, so a file rewritten with
+    #its old size and modification time still changes the key.
+    #Symlinked directories are
+    #followed, as pairFiles does, but each directory is only
+    #visited once so that a link back up the tree can't loop
+    try:
+        st = os.stat(dirname)
+        hasher.update(f"{dirname}\0{st.st_mtime_ns}\0{st.st_ctime_ns}\0{st.st_ino}\0{st.st_size}\n".encode(errors="surrogateescape"))
+    except OSError:
+        pass
+    stack=[dirname]
+    visited=set()
+    while len(stack):
+        d = stack.pop()
+        try:
+            entries = sorted(os.scandir(d), key=lambda e: e.name)
+        except OSError:
+            continue
+        for e in entries:
+            try:
+                st = e.stat()
+            except OSError:
+                continue
+            hasher.update(f"{e.path}\0{st.st_mtime_ns}\0{st.st_ctime_ns}\0{st.st_ino}\0{st.st_size}\n".encode(errors="surrogateescape"))
+            if e.is_dir() and (st.st_dev,st.st_ino) not in visited:
+                visited.add( (st.st_dev,st.st_ino) )
+                stack.append(e.path)
+
+def getCachedDifferences(dir1,dir2,ignoreGlobs,ignoreBlankLines):
+    #the changeset refers to files by the paths given on
+    #the command line, so those are part of the key too
+    hasher = hashlib.blake2b()
+    hasher.update(repr( (DIFF_CACHE_VERSION, dir1, dir2,
+        os.path.abspath(dir1), os.path.abspath(dir2), ignoreGlobs,
+        ignoreBlankLines) ).encode(errors="surrogateescape"))
+    getTreeSignature(dir1,hasher)
+    getTreeSignature(dir2,hasher)
+    cacheFile = os.path.join(DIFF_CACHE_DIR, hasher.hexdigest()+".pickle")
 
-def getDifferences(dir1,dir2):
+    try:
+        with open(cacheFile,"rb") as fp:
+            changeset = pickle.load(fp)
+        #mark it as recently used so pruning keeps it
+        os.utime(cacheFile)
+        return changeset
+    except Exception:
+        #missing or unreadable cache: just diff again
+        pass
+
+    changeset = getDifferences(dir1,dir2,ignoreGlobs,ignoreBlankLines)
+    try:
+        os.makedirs(DIFF_CACHE_DIR, exist_ok=True)
+        tmpFile = f"{cacheFile}.{os.getpid()}"
+        with open(tmpFile,"wb") as fp:
+            pickle.dump(changeset,fp,protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpFile,cacheFile)
+        pruneDiffCache()
+    except OSError:
+        pass
+    return changeset
+
+def pruneDiffCache():
+    #remove all but the most recently used cache files
+    cacheFiles=[]
+    with os.scandir(DIFF_CACHE_DIR) as it:
+        for e in it:
+            if e.name.endswith(".pickle"):
+                try:
+                    cacheFiles.append( (e.stat().st_mtime_ns, e.path) )
+                except OSError:
+                    pass
+    cacheFiles.sort(reverse=True)
+    for mtime,path in cacheFiles[DIFF_CACHE_MAX_FILES:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def pairFiles(dir1,dir2,ignoreRex):
+    #walk both trees side by side. Returns the (file1,file2)
+    #pairs present in both, plus the entries that only exist in
+    #dir1 (removed) or only in dir2 (added). Like diff -r, a
+    #directory that only exists on one side is reported once
+    #rather than file by file. Anything whose name matches
+    #ignoreRex is left out, apart from directories that are
+    #in both trees or only in dir2.
+
+    #like diff, two files are compared with each other, and a
+    #file and a directory compare the file with the file of the
+    #same name in the directory
+    if not os.path.isdir(dir1) or not os.path.isdir(dir2):
+        if os.path.isdir(dir1):
+            dir1 = os.path.join(dir1,os.path.basename(dir2))
+        elif os.path.isdir(dir2):
+            dir2 = os.path.join(dir2,os.path.basename(dir1))
+        return [(dir1,dir2)],[],[]
+
+    def dirId(st):
+        return (st.st_dev,st.st_ino)
+
+    pairs=[]
+    removed=[]
+    added=[]
+    #each entry also has the directories above it on each side,
+    #so that a symlink back up the tree is noticed instead of
+    #being followed forever
+    stack=[(dir1,dir2,(dirId(os.stat(dir1)),),(dirId(os.stat(dir2)),))]
+    while len(stack):
+        d1,d2,above1,above2 = stack.pop()
+        with os.scandir(d1) as it:
+            entries1 = {e.name: e for e in it}
+        with os.scandir(d2) as it:
+            entries2 = {e.name: e for e in it}
+        for name in sorted(entries1.keys() | entries2.keys()):
+            e1 = entries1.get(name)
+            e2 = entries2.get(name)
+            if e1 and e2 and e1.is_dir() and e2.is_dir():
+                id1 = dirId(e1.stat())
+                id2 = dirId(e2.stat())
+                if id1 == id2:
+                    #both sides are the same directory
+                    pass
+                elif id1 in above1 or id2 in above2:
+                    sys.stderr.write(f"{e1.path}: recursive directory loop\n")
+                else:
+                    stack.append( (e1.path,e2.path,above1+(id1,),above2+(id2,)) )
+            elif e1 is None and e2.is_dir():
+                #insertedEntireFile leaves out the ignored files
+                #inside an added directory, but the directory
+                #itself is kept whatever its name
+                added.append(e2.path)
+            elif ignoreRex.match(name):
+                pass
+            elif e2 is None:
+                removed.append(e1.path)
+            elif e1 is None:
+                added.append(e2.path)
+            elif e1.is_dir() or e2.is_dir():
+                #a file on one side and a directory on the other
+                removed.append(e1.path)
+                added.append(e2.path)
+            else:
+                pairs.append( (e1.path,e2.path) )
+    return pairs,removed,added
+
+def diffFiles(pair, ignoreBlankLines):
+    #run diff on a single pair of files and parse its output
+    fname1,fname2 = pair
+    #identical bytes means there's nothing to report, and
+    #checking that is much cheaper than starting diff. (Matching
+    #size and modification time isn't enough: two different
+    #files written in the same clock tick can have both.) If
+    #either file can't be read, diff is left to report it
+    try:
+        if filecmp.cmp(fname1,fname2,shallow=False):
+            return {}
+    except OSError:
+        pass
+    cmd = [ "diff", "--ignore-all-space" ]
+    if ignoreBlankLines:
+        cmd.append("--ignore-blank-lines")
+    cmd += [ "--unified=3", "--minimal", fname1, fname2 ]
+    P = subprocess.Popen( cmd, stdout=subprocess.PIPE )
+    #parse the lines as diff produces them. newline="\n" so
+    #that a stray \r in a file doesn't split a line in two
+    with P:
+        return parseDiff( io.TextIOWrapper(P.stdout, encoding="utf-8", errors="replace", newline="\n"), ignoreBlankLines )
+
+def getDifferences(dir1,dir2,ignoreGlobs,ignoreBlankLines):
     os.putenv("DFT_UNSTABLE","yes")
-    P = subprocess.Popen(
-        [
-            "diff",
-            "--ignore-all-space",
-            "--ignore-blank-lines",
-            "-r",
-            "--unified=3",
-            "--minimal",
-            dir1,
-            dir2
-        ],
-        stdout=subprocess.PIPE
-    )
 
-    o,e = P.communicate()
-    o = o.decode(errors="replace")
+    ignoreRex = compileGlobs(ignoreGlobs)
+    pairs,removed,added = pairFiles(dir1,dir2,ignoreRex)
 
     #indexed by filename
     changeset = {}
 
-    i=0
-    o=o.split("\n")
-    if len(o[-1]) == 0:
-        o.pop()
+    for fname in removed:
+        #entire file was deleted
+        changeset[fname]=FileChanges()
+        changeset[fname].add( ChangeType.REMOVED_FILE, -1, -1, fname )
+    for fname in added:
+        #entire file was inserted
+        insertedEntireFile( fname, changeset, ignoreRex, ignoreBlankLines )
+
+    #the real work happens in the diff processes, so threads
+    #are enough to keep them all busy
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        diffPair = functools.partial(diffFiles, ignoreBlankLines=ignoreBlankLines)
+        for fileChanges in executor.map(diffPair, pairs):
+            for fname in fileChanges:
+                assert fname not in changeset
+            changeset.update(fileChanges)
 
-    onlyInRex = re.compile(r"^Only in ([^:]+): (.+)")
-    binaryRex = re.compile(r"Binary files (.*) and (.*) differ")
+    return changeset
 
-    while i<len(o):
-        line = o[i]
-        # ~ print(line)
+#format:  @@ -file1spec +file2spec @@
+#spec can be:
+#       startline,count
+#       startline           <-- count is 1
+#The counts (which include context lines) aren't needed.
+#startline is 0 for an empty file
+hunkHeaderRex = re.compile(r"@@ -(\d+)(?:,\d+)? \+(\d+)(?:,\d+)? @@")
+
+#for lines inside a chunk, indexed by the first character:
+#the change type and how much each line number advances
+HUNK_LINE_TYPES = {
+    " ": (ChangeType.CONTEXT, 1, 1),
+    "-": (ChangeType.DELETED, 1, 0),
+    "+": (ChangeType.INSERTED, 0, 1)
+}
 
-        if line.startswith("diff "):
-            i+=1
-        elif line.startswith("Only in "):
-            M = onlyInRex.search(line)
-            assert M
+def parseDiff(lines, ignoreBlankLines):
+    #parse the output of diff for one pair of files, given as
+    #an iterable of lines. Returns a dict indexed by filename
+    #(which is empty if the files are the same). Lines that
+    #are blank or only whitespace are left out if
+    #ignoreBlankLines is true
+    changeset = {}
 
-            fname = os.path.join(M.group(1),M.group(2))
+    lines = iter(lines)
 
-            # ~ print("Added",fname,": From 'Only in'")
+    #true once the first @@ has been seen; after that, lines
+    #starting with - or + are content, even if they start
+    #with --- or +++
+    inHunk=False
 
-            if M.group(1).startswith(dir2):
-                #entire file was inserted
-                insertedEntireFile( fname, changeset )
-            elif M.group(1).startswith(dir1):
-                #entire file was deleted
-                assert fname not in changeset
-                changeset[fname]=[]
-                changeset[fname].append(
-                    ChangeInfo( type=ChangeType.REMOVED_FILE,
-                                line1=-1,
-                                line2=-1,
-                                content=fname
-                    )
-                )
-            else:
-                print("M=",M)
-                print("M.group(1)=",M.group(1))
-                print("dir1=",dir1)
-                print("dir2=",dir2)
-                assert 0,f"{line}"
-            i+=1
+    for line in lines:
+        # ~ print(line)
+
+        lineType = HUNK_LINE_TYPES.get(line[:1])
+        if lineType and inHunk:
+            #unchanged context, deleted content, or added content
+            changeType, delta1, delta2 = lineType
+            content = line[1:].rstrip()
+            if content or not ignoreBlankLines:
+                addChange( changeType, lineNum1, lineNum2, content )
+            lineNum1+=delta1
+            lineNum2+=delta2
+        elif line.startswith("diff "):
+            pass
         elif line.startswith("---"):
             line = line[4:].strip()
-            fname1 = line.split("\t")[0]
-            i+=1
-            line = o[i]
+            fname1 = line.partition("\t")[0]
+            line = next(lines)
             assert line.startswith("+++")
             line = line[4:].strip()
-            fname2 = line.split("\t")[0]
-            i+=1
+            fname2 = line.partition("\t")[0]
             #fname = os.path.basename(fname1)
             fname = fname2
             assert fname not in changeset
-            changeset[fname]=[]
+            changeset[fname]=FileChanges()
+            #looked up once here rather than for every line
+            addChange = changeset[fname].add
             # ~ print("Added",fname,"from ---")
 
         elif line.startswith("@@ "):
             #change set
-            #format:  @@ -file1spec +file2spec @@
-            #spec can be:
-            #       startline,count
-            #       startline           <-- count is 1
-            #Note: The counts include context (unchanged) lines
-            spec = line[2:].strip().split()
-            i+=1
-            if "," in spec[0]:
-                l,c = spec[0].split(",")
-            else:
-                l=spec[0]
-                c=1
-            assert l.startswith("-")
-            lineNum1 = int(l[1:])
-            if "," in spec[1]:
-                l,c = spec[1].split(",")
-            else:
-                l=spec[1]
-                c=1
-            assert l.startswith("+")
-            lineNum2 = int(l[1:])
-            assert lineNum1 > 0,f"{spec[0]}"
-            assert lineNum2 > 0,f"{spec[1]}"
-            changeset[fname].append(
-                ChangeInfo( type=ChangeType.NEW_CHUNK,
-                            line1=lineNum1,
-                            line2=lineNum2,
-                            content=(fname1,fname2)
-                )
-            )
-        elif line.startswith(" "):
-            #unchanged context
-            changeset[fname].append(
-                ChangeInfo(
-                    type=ChangeType.CONTEXT,
-                    line1=lineNum1,
-                    line2=lineNum2,
-                    content=line[1:].rstrip()
-                )
-            )
-            lineNum1+=1
-            lineNum2+=1
-            i+=1
-        elif line.startswith("-"):
-            #deleted content
-            changeset[fname].append( ChangeInfo(
-                type=ChangeType.DELETED,
-                line1=lineNum1,
-                line2=lineNum2,
-                content=line[1:].rstrip()
-            ))
-            lineNum1+=1
-            i+=1
-        elif line.startswith("+"):
-            #added content
-            changeset[fname].append( ChangeInfo(
-                type=ChangeType.INSERTED,
-                line1=lineNum1,
-                line2=lineNum2,
-                content=line[1:].rstrip()
-            ))
-            lineNum2+=1
-            i+=1
-        elif line == "\\ No newline at end of file":
-            i+=1
-        elif line.startswith("Binary files ") and line.endswith(" differ"):
-            M = binaryRex.search(line)
-            fname = M.group(1)
+            M = hunkHeaderRex.match(line)
+            assert M,f"-->{line}<--"
+            lineNum1 = int(M.group(1))
+            lineNum2 = int(M.group(2))
+            addChange( ChangeType.NEW_CHUNK, lineNum1, lineNum2, (fname1,fname2) )
+            inHunk=True
+        elif line.startswith("\\ "):
+            #\ No newline at end of file
+            pass
+        elif line.startswith("Binary files "):
+            #"Binary files X and Y differ"
+            line = line.rstrip("\n")
+            assert line.endswith(" differ"),f"-->{line}<--"
+            fname = line[len("Binary files "):-len(" differ")].rpartition(" and ")[0]
             #fname = os.path.basename(fname)
             assert fname not in changeset,f"{fname}  ::  {changeset.keys()}"
-            changeset[fname] = [
-                ChangeInfo(
-                    type=ChangeType.DIFFERING_BINARY,
-                    line1=0,
-                    line2=0,
-                    content=fname
-                )
-            ]
+            changeset[fname] = FileChanges()
+            changeset[fname].add( ChangeType.DIFFERING_BINARY, 0, 0, fname )
             # ~ print("Added",fname,"from binary differ")
-            i+=1
         else:
             assert 0, f"-->{str(line)}<--"
 
     return changeset
 
 
-main()
-
-
-
-
-    #note: 0,0 is bottom left corner
-
-    #cvs.line( x,y,x,y )
-    #cvs.rect(x,y,w,h,stroke={0,1},fill={0,1})
-    #cvs.drawString(x,y,txt)
-    #cvs.drawRightString(x,y,txt)
-    #cvs.drawCentredString(x,y,txt)
-    #t = cvs.beginText(x,y)
-    #t.setTextOrigin(x,y)   <-- sets location for next output
-    #t.moveCursor(dx,dy)    <-- delta from start of current line
-    #                       <-- y>0 = down
-    #x=t.getX()
-    #y=t.getY()
-    #t.setCharSpace(s)  <-- s=floating point
-    #t.setWordSpace(s)  <-- s=floating point
-    #t.setLeading(s)
-    #t.setRise(s)       <-- superscript/subscript
-    #t.setFillColor(...)
-    #t.setStrokeColor(...)
-    #t.textOut(txt)
-    #t.textLine(txt)
-    #t.textLines(txt,trim=1)
-
-    #cvs.drawText(t)
-    #cvs.showPage  <-- resets all page state
-    #cvs.setFillColorRGB(r,g,b)
-    #cvs.setStrokeColorRGB(r,g,b)
-    #cvs.setFont(fontname, size)
-    #cvs.setLineWidth(w)
-    #cvs.saveState()
-    #cvs.restoreState()
-    #w = reportlab.pdfbase.pdfmetrics.stringWidth(text,fontname,size)
-    #line spacing is the height
-
-
-    #P = reportlab.platypus.Paragraph("This is some text")
-    #params: available width and height
-    #returned: actual width and height required
-    #w,h = P.wrap(200,400)
-    #P.drawOn(cvs,0,400)     #canvas, x,y locations
-
-#<font name="foo" color="bar" size="14">...</font>
-#<b>...</b>
-#<i>...</i>
+if __name__ == "__main__":
+    main()